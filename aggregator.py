@@ -8,14 +8,94 @@ import requests
 import socket
 import os
 import subprocess
+import tarfile
+import threading
 import time
 import concurrent.futures
+import itertools
 from datetime import datetime
-import pytz
-from collections import defaultdict
+from collections import Counter
 import base64
 import gzip
 import re
+import json
+import sqlite3
+import asyncio
+
+# Heavy modules (maxminddb, pytz, dnspython) are imported lazily at
+# their single point of use — they cost noticeable cold-start time and
+# none of them is needed before the fetch/test stages finish
+
+HAS_ASYNC_DNS = None
+
+def _async_dns_available():
+    """Import dnspython on first use; remember the answer"""
+    global HAS_ASYNC_DNS
+    if HAS_ASYNC_DNS is None:
+        try:
+            import dns.asyncresolver  # noqa: F401
+            HAS_ASYNC_DNS = True
+        except ImportError:
+            HAS_ASYNC_DNS = False
+    return HAS_ASYNC_DNS
+
+_IPV4_RE = re.compile(r'^\d{1,3}(?:\.\d{1,3}){3}$')
+
+# Loopback/private/invalid server patterns, compiled once as a single
+# alternation — is_valid_server runs per fetched node and matching one
+# combined regex beats nine separate re.match calls
+_INVALID_SERVER_RE = re.compile(
+    r'^(?:'
+    r'127\.'                            # Localhost
+    r'|0\.'                             # Invalid
+    r'|localhost'                       # Localhost
+    r'|192\.168\.'                      # Private network
+    r'|10\.'                            # Private network
+    r'|172\.(?:1[6-9]|2[0-9]|3[01])\.'  # Private network
+    r'|::1$'                            # IPv6 localhost
+    r'|fe80:'                           # IPv6 link-local
+    r'|fc00:'                           # IPv6 private
+    r')'
+)
+
+# Share-link schemes recognized in plain-text subscription lists
+_NODE_URL_PREFIXES = ('vmess://', 'ss://', 'trojan://')
+
+# Persisted geo-cache TTLs: trust a resolved country as long as
+# MaxMind's weekly update cadence, but retry 'UN' rows daily — they
+# are usually transient DNS failures, not real answers
+_CACHE_TTL = 7 * 24 * 3600
+_CACHE_TTL_UN = 24 * 3600
+
+# libyaml parses roughly an order of magnitude faster than the pure
+# Python loader; fall back when PyYAML was built without it
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+# libyaml's emitter escapes non-BMP characters (all the flag emoji in
+# node names) even with allow_unicode, so the published clash.yaml
+# sticks with SafeDumper; the C dumper is for machine-read files only
+_YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# Shared session for subscription fetching: keeps TCP/TLS connections
+# to the subconverter endpoints alive across requests instead of paying
+# a fresh handshake per URL. Session is thread-safe, and the pool is
+# sized for the fetch thread pool hitting a handful of hosts.
+_SESSION = requests.Session()
+_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=50))
+_SESSION.mount('http://', requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=50))
+
+def _ipv4_to_int(ip):
+    """Convert a dotted IPv4 string to an int, None if not IPv4"""
+    # inet_aton parses in C — far cheaper than split() plus four int()
+    # calls per address in the bulk sort path. The regex guard keeps
+    # this strict dotted-quad, as inet_aton also accepts short forms
+    # like '1.2.3'.
+    if not _IPV4_RE.match(ip):
+        return None
+
+    try:
+        return int.from_bytes(socket.inet_aton(ip), 'big')
+    except OSError:
+        return None
 
 def download_clash_core():
     """Download Clash core if not present"""
@@ -49,27 +129,385 @@ def download_clash_core():
     
     return False
 
+def download_geoip_db(db_path='GeoLite2-Country.mmdb'):
+    """Download GeoLite2 database if not present"""
+    if os.path.exists(db_path):
+        print("✅ GeoIP database found")
+        return True
+
+    edition = db_path.replace('.mmdb', '')
+    urls = [
+        f"https://github.com/P3TERX/GeoLite.mmdb/raw/download/{edition}.mmdb"
+    ]
+
+    license_key = os.environ.get('MAXMIND_LICENSE_KEY')
+    if license_key:
+        urls.insert(0, (
+            "https://download.maxmind.com/app/geoip_download"
+            f"?edition_id={edition}&license_key={license_key}&suffix=tar.gz"
+        ))
+
+    for url in urls:
+        try:
+            response = requests.get(url, stream=True, timeout=60)
+            if response.status_code != 200:
+                continue
+
+            if 'tar.gz' in url:
+                with open('geoip.tar.gz', 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        f.write(chunk)
+
+                with tarfile.open('geoip.tar.gz', 'r:gz') as tar:
+                    for member in tar.getmembers():
+                        if member.name.endswith('.mmdb'):
+                            member.name = db_path
+                            tar.extract(member)
+                            break
+                os.remove('geoip.tar.gz')
+            else:
+                with open(db_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        f.write(chunk)
+
+            if os.path.exists(db_path):
+                print("✅ GeoIP database downloaded")
+                return True
+        except Exception as e:
+            print(f"   ❌ Failed: {e}")
+
+    return False
+
+class GeoDetector:
+    """Detect server locations using a local MaxMind database"""
+
+    def __init__(self, db_path='GeoLite2-Country.mmdb', cache_path='geo_cache.db'):
+        # The Country database is an order of magnitude smaller than
+        # City and answers iso_code lookups with the same precision
+        self.reader = self._open_reader(db_path)
+        self.cache_path = cache_path
+        self.cache = self._load_cache(cache_path)
+        self.ip_cache = {}
+        self.cache_lock = threading.Lock()
+
+    def _load_cache(self, cache_path):
+        """Load the {server: country} cache persisted by a previous run.
+
+        Rows past their TTL are deleted on load, so weekly GeoLite2
+        country reassignments propagate, a transient failure cached as
+        'UN' gets retried the next day instead of sticking forever, and
+        the table cannot grow without bound. Servers loaded here are
+        remembered so _save_cache can skip rewriting their rows.
+        """
+        cache = {}
+        self._persisted = set()
+        try:
+            con = sqlite3.connect(cache_path)
+            con.execute(
+                'CREATE TABLE IF NOT EXISTS locations '
+                '(server TEXT PRIMARY KEY, country TEXT NOT NULL, '
+                'resolved_at REAL NOT NULL DEFAULT 0)'
+            )
+            # Migrate a pre-TTL table: its rows carry no timestamp
+            # (default 0), so they expire below and get re-resolved
+            columns = [row[1] for row in con.execute('PRAGMA table_info(locations)')]
+            if 'resolved_at' not in columns:
+                con.execute(
+                    'ALTER TABLE locations '
+                    'ADD COLUMN resolved_at REAL NOT NULL DEFAULT 0'
+                )
+
+            now = time.time()
+            con.execute(
+                'DELETE FROM locations WHERE resolved_at < ?',
+                (now - _CACHE_TTL,)
+            )
+            con.execute(
+                "DELETE FROM locations WHERE country = 'UN' AND resolved_at < ?",
+                (now - _CACHE_TTL_UN,)
+            )
+            con.commit()
+
+            cache = dict(con.execute('SELECT server, country FROM locations'))
+            self._persisted = set(cache)
+            con.close()
+        except Exception:
+            pass
+
+        # Migrate the legacy JSON cache once, then drop it — its
+        # entries stay out of _persisted so they land on the next save
+        try:
+            with open('geo_cache.json', 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+            if isinstance(legacy, dict):
+                cache.update(legacy)
+                # Migrated values may differ from what's on disk, so
+                # they must be written even where a row already exists
+                self._persisted -= set(legacy)
+            os.remove('geo_cache.json')
+        except Exception:
+            pass
+
+        if cache:
+            print(f"   ✅ Loaded {len(cache)} cached locations")
+        return cache
+
+    def _save_cache(self):
+        """Persist the country cache so the next run skips known hosts.
+
+        'UN' entries are kept too — dead hosts recur across runs and
+        each one costs a full DNS timeout to re-discover. Only servers
+        that were not loaded from the database this run are written —
+        untouched rows keep their on-disk resolved_at so the TTL in
+        _load_cache keeps aging them — and INSERT OR REPLACE makes
+        re-resolved values overwrite stale rows instead of being
+        silently dropped.
+        """
+        try:
+            now = time.time()
+            with self.cache_lock:
+                snapshot = [(s, c, now) for s, c in self.cache.items()
+                            if s not in self._persisted]
+            if not snapshot:
+                return
+            con = sqlite3.connect(self.cache_path)
+            con.execute(
+                'CREATE TABLE IF NOT EXISTS locations '
+                '(server TEXT PRIMARY KEY, country TEXT NOT NULL, '
+                'resolved_at REAL NOT NULL DEFAULT 0)'
+            )
+            con.executemany(
+                'INSERT OR REPLACE INTO locations VALUES (?, ?, ?)', snapshot
+            )
+            con.commit()
+            con.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _open_reader(db_path):
+        import maxminddb
+
+        try:
+            try:
+                # Memory-map through the C extension: lookups share the
+                # page cache and skip per-read Python buffer copies
+                return maxminddb.open_database(db_path, mode=maxminddb.MODE_MMAP_EXT)
+            except ValueError:
+                # C extension not installed; plain mmap still beats
+                # reading the tree through Python file I/O
+                return maxminddb.open_database(db_path, mode=maxminddb.MODE_MMAP)
+        except Exception as e:
+            print(f"   ⚠️ GeoIP database unavailable: {e}")
+            return None
+
+    def _is_ip(self, server):
+        """Check if server is already an IPv4 address"""
+        # Cheap regex guard first: most servers are domain names, and
+        # letting inet_aton raise on each of them costs an exception
+        # per call. inet_aton only runs on likely-IP strings to reject
+        # out-of-range octets like 999.999.999.999.
+        if not _IPV4_RE.match(server):
+            return False
+
+        try:
+            socket.inet_aton(server)
+            return True
+        except OSError:
+            return False
+
+    def _resolve(self, server):
+        """Resolve hostname to IP (DNS only, failures cached as None)"""
+        if self._is_ip(server):
+            return server
+
+        with self.cache_lock:
+            if server in self.ip_cache:
+                return self.ip_cache[server]
+
+        try:
+            ip = socket.gethostbyname(server)
+        except Exception:
+            # Cache the miss too: dead hosts show up repeatedly and
+            # re-resolving them wastes a full DNS timeout each time
+            ip = None
+
+        with self.cache_lock:
+            self.ip_cache[server] = ip
+
+        return ip
+
+    def _lookup_ip(self, ip):
+        """Look up country code for an IP (mmdb only)"""
+        if not self.reader or not ip:
+            return 'UN'
+
+        try:
+            record = self.reader.get(ip)
+        except ValueError:
+            return 'UN'
+
+        return ((record or {}).get('country') or {}).get('iso_code') or 'UN'
+
+    def _lookup_ips(self, ips):
+        """Bulk country lookup, returns {ip: country}.
+
+        Sorting the IPs first means consecutive addresses often fall in
+        the same network; get_with_prefix_len reports that network's
+        prefix length, so repeats within it skip the tree walk entirely.
+        """
+        results = {}
+        if not self.reader:
+            return {ip: 'UN' for ip in ips}
+
+        last_net = None
+        last_prefix = 0
+        last_country = 'UN'
+
+        for ip in sorted(set(ips), key=lambda s: _ipv4_to_int(s) or 0):
+            ip_int = _ipv4_to_int(ip)
+
+            if last_net is not None and ip_int is not None \
+                    and (ip_int >> (32 - last_prefix)) == last_net:
+                results[ip] = last_country
+                continue
+
+            try:
+                record, prefix_len = self.reader.get_with_prefix_len(ip)
+            except ValueError:
+                results[ip] = 'UN'
+                continue
+
+            country = ((record or {}).get('country') or {}).get('iso_code') or 'UN'
+            results[ip] = country
+
+            # IPv4 sits at the bottom of the v6 tree, so strip the
+            # 96-bit ::ffff:0:0/96 prefix before caching the network
+            if prefix_len > 32:
+                prefix_len -= 96
+            if ip_int is not None and 0 < prefix_len <= 32:
+                last_net = ip_int >> (32 - prefix_len)
+                last_prefix = prefix_len
+                last_country = country
+
+        return results
+
+    def get_location(self, server):
+        """Get country code for a server (cached)"""
+        if not server:
+            return 'UN'
+
+        with self.cache_lock:
+            if server in self.cache:
+                return self.cache[server]
+
+        country = self._lookup_ip(self._resolve(server))
+
+        with self.cache_lock:
+            self.cache[server] = country
+
+        return country
+
+    async def _resolve_all_async(self, servers, limit=2000):
+        """Resolve hostnames over one shared async resolver socket.
+
+        A single long-lived resolver with thousands of in-flight queries
+        avoids the per-query socket setup/teardown that serializes
+        gethostbyname.
+        """
+        import dns.asyncresolver
+
+        resolver = dns.asyncresolver.Resolver()
+        resolver.nameservers = ['1.1.1.1', '8.8.8.8']
+        resolver.lifetime = 5
+        semaphore = asyncio.Semaphore(limit)
+
+        async def resolve_one(server):
+            if self._is_ip(server):
+                return server, server
+            async with semaphore:
+                try:
+                    answer = await resolver.resolve(server, 'A')
+                    return server, answer[0].address
+                except Exception:
+                    return server, None
+
+        results = await asyncio.gather(*[resolve_one(s) for s in servers])
+        return dict(results)
+
+    def _iter_resolved(self, servers, max_workers=64, chunk=512):
+        """Yield (server, ip) pairs as resolutions complete.
+
+        The async path works in chunks so answers start flowing before
+        the whole batch is done; the thread-pool fallback streams one
+        future at a time via as_completed.
+        """
+        if _async_dns_available():
+            for i in range(0, len(servers), chunk):
+                batch = servers[i:i + chunk]
+                yield from asyncio.run(self._resolve_all_async(batch)).items()
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(self._resolve, s): s for s in servers}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        ip = future.result()
+                    except Exception:
+                        ip = None
+                    yield futures[future], ip
+
+    def _locate_batch(self, batch):
+        """Bulk-look-up one chunk of (server, ip) pairs and cache them"""
+        ip_to_country = self._lookup_ips([ip for _, ip in batch if ip])
+        located = []
+
+        with self.cache_lock:
+            for server, ip in batch:
+                country = ip_to_country.get(ip, 'UN')
+                self.ip_cache[server] = ip
+                self.cache[server] = country
+                located.append((server, country))
+
+        return located
+
+    def iter_locations(self, servers, max_workers=64):
+        """Resolve and geo-locate servers, yielding (server, country).
+
+        One pipelined pass: cached servers come out immediately and the
+        rest stream in resolution-completion order, with the sorted
+        bulk mmdb lookup applied per chunk of arrivals — the caller
+        starts consuming answers long before the slowest DNS query in
+        the batch times out.
+        """
+        with self.cache_lock:
+            known = [(s, self.cache[s]) for s in servers if s and s in self.cache]
+            pending = [s for s in servers if s and s not in self.cache]
+
+        yield from known
+
+        batch = []
+        for server, ip in self._iter_resolved(pending, max_workers):
+            batch.append((server, ip))
+            if len(batch) >= 256:
+                yield from self._locate_batch(batch)
+                batch = []
+
+        if batch:
+            yield from self._locate_batch(batch)
+
+    def close(self):
+        self._save_cache()
+        if self.reader:
+            self.reader.close()
+
 def is_valid_server(server):
     """Check if server address is valid"""
     if not server:
         return False
     
     # Reject invalid patterns
-    invalid_patterns = [
-        r'^127\.',           # Localhost
-        r'^0\.',              # Invalid
-        r'^localhost',        # Localhost
-        r'^192\.168\.',       # Private network
-        r'^10\.',             # Private network  
-        r'^172\.(1[6-9]|2[0-9]|3[01])\.',  # Private network
-        r'^::1$',             # IPv6 localhost
-        r'^fe80:',            # IPv6 link-local
-        r'^fc00:',            # IPv6 private
-    ]
-    
-    for pattern in invalid_patterns:
-        if re.match(pattern, server.lower()):
-            return False
+    if _INVALID_SERVER_RE.match(server.lower()):
+        return False
     
     # Check if it looks like a valid domain or IP
     if '.' not in server and ':' not in server:
@@ -143,9 +581,12 @@ def fetch_subscription_resilient(url):
                 'list': 'true'
             }
             
-            response = requests.get(endpoint, params=params, timeout=60)
+            # Stream the body straight into the parser instead of
+            # buffering the full text and decoding it twice
+            response = _SESSION.get(endpoint, params=params, timeout=60, stream=True)
             if response.status_code == 200:
-                data = yaml.safe_load(response.text)
+                response.raw.decode_content = True
+                data = yaml.load(response.raw, Loader=_YAML_LOADER)
                 if data and 'proxies' in data:
                     return data['proxies']
         except:
@@ -156,12 +597,12 @@ def fetch_subscription_resilient(url):
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
-        response = requests.get(url, headers=headers, timeout=60)
+        response = _SESSION.get(url, headers=headers, timeout=60)
         content = response.text
         
         # Try YAML
         try:
-            data = yaml.safe_load(content)
+            data = yaml.load(content, Loader=_YAML_LOADER)
             if isinstance(data, dict) and 'proxies' in data:
                 return data['proxies']
             elif isinstance(data, list):
@@ -172,7 +613,7 @@ def fetch_subscription_resilient(url):
         # Try base64
         try:
             decoded = base64.b64decode(content).decode('utf-8')
-            data = yaml.safe_load(decoded)
+            data = yaml.load(decoded, Loader=_YAML_LOADER)
             if isinstance(data, dict) and 'proxies' in data:
                 return data['proxies']
             elif isinstance(data, list):
@@ -183,7 +624,7 @@ def fetch_subscription_resilient(url):
         # Try as URL list
         lines = content.strip().split('\n')
         for line in lines:
-            if line.startswith(('vmess://', 'ss://', 'trojan://')):
+            if line.startswith(_NODE_URL_PREFIXES):
                 # Basic parsing (you can expand this)
                 raw_nodes.append({'type': 'vmess', 'server': 'unknown', 'port': 443, 'name': 'parsed'})
         
@@ -269,16 +710,17 @@ def pre_filter_nodes(nodes, max_workers=50):
 class ProxyTester:
     """Test proxies and detect real exit locations"""
     
-    def __init__(self, clash_path='./clash'):
+    def __init__(self, clash_path='./clash', geo=None):
         self.clash_path = clash_path
         self.base_port = 9000
-        
-        # Get server's real IP first
+        self.geo = geo
+
+        # Get server's real IP first — only the IP comes over the
+        # network; the country is answered by the local database
         try:
-            response = requests.get('http://ip-api.com/json', timeout=5)
-            data = response.json()
-            self.server_ip = data.get('query')
-            self.server_country = data.get('countryCode')
+            response = requests.get('http://api.ipify.org', timeout=5)
+            self.server_ip = response.text.strip()
+            self.server_country = geo.get_location(self.server_ip) if geo else 'UN'
             print(f"\n📍 Server location: {self.server_country} ({self.server_ip})")
         except:
             self.server_ip = None
@@ -324,7 +766,8 @@ class ProxyTester:
         
         config_file = f'test-{port}.yaml'
         with open(config_file, 'w') as f:
-            yaml.dump(config, f)
+            yaml.dump(config, f, Dumper=_YAML_DUMPER, allow_unicode=True,
+                      default_flow_style=False)
         
         process = None
         try:
@@ -385,40 +828,37 @@ class ProxyTester:
                 'https': f'http://127.0.0.1:{port}'
             }
             
-            # Get exit location
+            # Only the exit IP crosses the wire; the country comes from
+            # the local mmdb, so ip-api.com (and its rate limit) is out
+            # of the hot path entirely
             response = requests.get(
-                'http://ip-api.com/json?fields=status,countryCode,country,city,query,isp',
+                'http://api.ipify.org',
                 proxies=proxies,
                 timeout=2
             )
-            
+
             if response.status_code == 200:
-                data = response.json()
-                
-                if data.get('status') == 'success':
-                    exit_ip = data.get('query')
-                    country = data.get('countryCode', 'UN')
-                    
-                    # CRITICAL CHECK: Is this actually going through proxy?
-                    if exit_ip and exit_ip != self.server_ip:
-                        # Traffic IS going through proxy!
-                        result = {
-                            'alive': True,
-                            'is_proxy': True,
-                            'country': country,
-                            'ip': exit_ip,
-                            'city': data.get('city'),
-                            'isp': data.get('isp')
-                        }
-                    else:
-                        # Traffic is going DIRECT (not through proxy)
-                        result = {
-                            'alive': True,
-                            'is_proxy': False,
-                            'country': self.server_country,
-                            'ip': self.server_ip,
-                            'city': 'DIRECT'
-                        }
+                exit_ip = response.text.strip()
+
+                # CRITICAL CHECK: Is this actually going through proxy?
+                if exit_ip and exit_ip != self.server_ip:
+                    # Traffic IS going through proxy!
+                    result = {
+                        'alive': True,
+                        'is_proxy': True,
+                        'country': self.geo.get_location(exit_ip) if self.geo else 'UN',
+                        'ip': exit_ip,
+                        'city': None
+                    }
+                else:
+                    # Traffic is going DIRECT (not through proxy)
+                    result = {
+                        'alive': True,
+                        'is_proxy': False,
+                        'country': self.server_country,
+                        'ip': self.server_ip,
+                        'city': 'DIRECT'
+                    }
         
         except Exception as e:
             # Connection failed
@@ -435,8 +875,10 @@ def deduplicate_nodes(nodes):
         if not isinstance(node, dict):
             continue
         
-        key = f"{node.get('server')}:{node.get('port')}:{node.get('type')}"
-        
+        # Tuple key: hashing three small objects beats formatting and
+        # hashing a throwaway f-string per node
+        key = (node.get('server'), node.get('port'), node.get('type'))
+
         if key not in seen:
             seen.add(key)
             unique.append(node)
@@ -485,26 +927,13 @@ def create_proxy_groups(all_names, sg_names):
 
 def get_flag_emoji(code):
     """Get flag emoji for country code"""
-    flags = {
-        'SG': '🇸🇬', 'US': '🇺🇸', 'JP': '🇯🇵', 'KR': '🇰🇷', 'HK': '🇭🇰',
-        'TW': '🇹🇼', 'CN': '🇨🇳', 'GB': '🇬🇧', 'DE': '🇩🇪', 'FR': '🇫🇷',
-        'NL': '🇳🇱', 'CA': '🇨🇦', 'AU': '🇦🇺', 'IN': '🇮🇳', 'TH': '🇹🇭',
-        'MY': '🇲🇾', 'ID': '🇮🇩', 'PH': '🇵🇭', 'VN': '🇻🇳', 'TR': '🇹🇷',
-        'AE': '🇦🇪', 'RU': '🇷🇺', 'BR': '🇧🇷', 'AR': '🇦🇷', 'MX': '🇲🇽',
-        'IT': '🇮🇹', 'ES': '🇪🇸', 'SE': '🇸🇪', 'NO': '🇳🇴', 'FI': '🇫🇮',
-        'DK': '🇩🇰', 'PL': '🇵🇱', 'UA': '🇺🇦', 'RO': '🇷🇴', 'CZ': '🇨🇿',
-        'AT': '🇦🇹', 'CH': '🇨🇭', 'BE': '🇧🇪', 'IE': '🇮🇪', 'NZ': '🇳🇿',
-        'ZA': '🇿🇦', 'EG': '🇪🇬', 'IL': '🇮🇱', 'SA': '🇸🇦', 'CL': '🇨🇱',
-        'CO': '🇨🇴', 'PE': '🇵🇪', 'VE': '🇻🇪', 'EC': '🇪🇨', 'PT': '🇵🇹',
-        'GR': '🇬🇷', 'HU': '🇭🇺', 'IS': '🇮🇸', 'LU': '🇱🇺', 'SK': '🇸🇰',
-        'SI': '🇸🇮', 'BG': '🇧🇬', 'HR': '🇭🇷', 'RS': '🇷🇸', 'LT': '🇱🇹',
-        'LV': '🇱🇻', 'EE': '🇪🇪', 'MD': '🇲🇩', 'AM': '🇦🇲', 'GE': '🇬🇪',
-        'AZ': '🇦🇿', 'KZ': '🇰🇿', 'UZ': '🇺🇿', 'BD': '🇧🇩', 'LK': '🇱🇰',
-        'MM': '🇲🇲', 'KH': '🇰🇭', 'LA': '🇱🇦', 'MO': '🇲🇴', 'PK': '🇵🇰',
-        'CW': '🇨🇼', 'DO': '🇩🇴', 'PA': '🇵🇦', 'CR': '🇨🇷', 'UY': '🇺🇾',
-        'IR': '🇮🇷', 'KE': '🇰🇪', 'NG': '🇳🇬', 'TN': '🇹🇳', 'LY': '🇱🇾'
-    }
-    return flags.get(code.upper(), '❓')
+    # A flag emoji is just the two regional-indicator codepoints for
+    # the ISO code (A -> U+1F1E6), so compute it instead of keeping a
+    # hand-maintained country table that was always a release behind
+    code = code.upper()
+    if code == 'UN' or len(code) != 2 or not code.isascii() or not code.isalpha():
+        return '\u2753'
+    return chr(0x1F1E6 + ord(code[0]) - 65) + chr(0x1F1E6 + ord(code[1]) - 65)
 
 def main():
     start_time = time.time()
@@ -543,8 +972,13 @@ def main():
         print("❌ No reachable nodes found")
         return
     
+    # The local GeoIP database answers every country question from here
+    # on — the tester needs it for exit-IP lookups
+    download_geoip_db()
+    geo = GeoDetector()
+
     # Test proxies
-    tester = ProxyTester()
+    tester = ProxyTester(geo=geo)
     tested_nodes = tester.test_proxies(reachable_nodes)
     
     # Filter only REAL working proxies (not DIRECT)
@@ -567,41 +1001,58 @@ def main():
         print("\n❌ No working proxies found!")
         return
     
-    # Group by country
-    country_nodes = defaultdict(list)
-    
+    # Geo-detect servers with the local database
+    print(f"\n🌍 Detecting locations for {len(real_proxies)} proxies...")
+
+    # Fused resolve/lookup/group pipeline: nodes whose exit country the
+    # tester already knows are grouped immediately, the rest are
+    # bucketed by unique host and flow into their groups as DNS answers
+    # stream out of iter_locations
+    country_nodes = {}
+    country_counts = Counter()
+    pending_nodes = {}
+
+    def add_node(country, node):
+        country_nodes.setdefault(country, []).append(node)
+        country_counts[country] += 1
+
     for node in real_proxies:
         country = node['test_result'].get('country', 'UN')
-        country_nodes[country].append(node)
-    
+        server = node.get('server')
+        if country != 'UN':
+            add_node(country, node)
+        elif server:
+            pending_nodes.setdefault(server, []).append(node)
+        else:
+            add_node('UN', node)
+
+    for host, country in geo.iter_locations(pending_nodes):
+        for node in pending_nodes[host]:
+            add_node(country, node)
+
     # Show distribution
     print(f"\n🌍 Country Distribution (REAL proxies only):")
     sg_nodes = country_nodes.get('SG', [])
     print(f"\n🇸🇬 SG: {len(sg_nodes)} nodes")
-    
-    for country, nodes in sorted(country_nodes.items(), key=lambda x: len(x[1]), reverse=True):
+
+    for country, count in country_counts.most_common():
         flag = get_flag_emoji(country)
-        print(f"   {flag} {country}: {len(nodes)} nodes")
+        print(f"   {flag} {country}: {count} nodes")
+
+    geo.close()
     
-    # Rename nodes
+    # Rename nodes in one pass — Singapore first, then the rest in
+    # grouping order
     renamed_nodes = []
     sg_node_names = []
     all_node_names = []
-    
-    # Singapore first
-    for idx, node in enumerate(sg_nodes, 1):
-        node_name = f"🇸🇬 SG-{idx:03d}"
-        node['name'] = node_name
-        node.pop('test_result', None)
-        renamed_nodes.append(node)
-        sg_node_names.append(node_name)
-        all_node_names.append(node_name)
-    
-    # Other countries
-    for country, nodes in country_nodes.items():
-        if country == 'SG':
-            continue
-        
+
+    ordered_groups = itertools.chain(
+        (('SG', sg_nodes),) if sg_nodes else (),
+        ((c, ns) for c, ns in country_nodes.items() if c != 'SG')
+    )
+
+    for country, nodes in ordered_groups:
         flag = get_flag_emoji(country)
         for idx, node in enumerate(nodes, 1):
             node_name = f"{flag} {country}-{idx:03d}"
@@ -609,6 +1060,8 @@ def main():
             node.pop('test_result', None)
             renamed_nodes.append(node)
             all_node_names.append(node_name)
+            if country == 'SG':
+                sg_node_names.append(node_name)
     
     if not all_node_names:
         print("❌ No valid nodes for output")
@@ -625,6 +1078,8 @@ def main():
     }
     
     # Write output
+    import pytz
+
     tz = pytz.timezone('Asia/Yangon')
     update_time = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S MMT')
     
@@ -634,7 +1089,8 @@ def main():
         f.write(f"# Singapore Nodes: {len(sg_node_names)}\n")
         f.write(f"# Note: All proxies verified working (not DIRECT)\n")
         f.write("# Generated by Clash-Aggregator\n\n")
-        yaml.dump(output, f, allow_unicode=True, default_flow_style=False)
+        yaml.dump(output, f, Dumper=yaml.SafeDumper, allow_unicode=True,
+                  default_flow_style=False)
         f.write(f"tun:\n")
         f.write(f"  enable: true\n")
         f.write(f"  stack: system\n")